@@ -0,0 +1,71 @@
+# Animation timelines: each animated thing (e.g. a keyb.py Button) gets
+# its own Timeline, with a start time, duration and easing curve, rather
+# than all sharing one global phase.  Times are in ms on a monotonic
+# clock, e.g. pygame.time.get_ticks().
+#
+# An Animator holds the Timelines still running; step() works out only
+# those and drops them once finished, so something at rest costs nothing
+# per frame.
+
+
+# Value going from frm to to over duration ms from start, shaped by curve
+# (a function of 0-1 to 0-1, e.g. from pytweening).  A pulse instead goes
+# from frm to to and back over each duration, repeating until replaced.
+
+class Timeline:
+
+	def __init__(self, start, duration, curve, frm, to, pulse=False):
+	  self.start    = start
+	  self.duration = max(duration, 1)
+	  self.curve    = curve
+	  self.frm      = frm
+	  self.to       = to
+	  self.pulse    = pulse
+
+	def value(self, now):
+	  t = (now - self.start) / float(self.duration)
+	  if self.pulse:
+	    t = 1.0 - abs(2.0 * (t % 1.0) - 1.0) # 0 -> 1 -> 0 each duration
+	  else:
+	    t = min(max(t, 0.0), 1.0)
+	  return self.frm + (self.to - self.frm) * self.curve(t)
+
+	def finished(self, now):
+	  return not self.pulse and now - self.start >= self.duration
+
+
+class Animator:
+
+	def __init__(self):
+	  self.timelines = {} # Animated object -> its running Timeline
+
+	def __contains__(self, obj):
+	  return obj in self.timelines
+
+	def __len__(self):
+	  return len(self.timelines)
+
+	# Run timeline for obj, replacing any it had
+	def start(self, obj, timeline):
+	  self.timelines[obj] = timeline
+
+	def stop(self, obj):
+	  self.timelines.pop(obj, None)
+
+	def clear(self):
+	  self.timelines.clear()
+
+	# obj's current value, or default if it isn't animating
+	def value(self, obj, now, default=0):
+	  timeline = self.timelines.get(obj)
+	  return default if timeline is None else timeline.value(now)
+
+	# (object, value) for every running Timeline at time now.  Finished
+	# ones are included once, with their final value, then dropped.
+	def step(self, now):
+	  values = []
+	  for obj, timeline in self.timelines.items():
+	    values.append((obj, timeline.value(now)))
+	    if timeline.finished(now):
+	      del self.timelines[obj]
+	  return values
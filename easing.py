@@ -0,0 +1,30 @@
+# Easing lookup tables: samples an easing function (e.g. one of
+# pytweening's) once, at a fixed resolution, so evaluating it per key per
+# frame is an index into a list however costly the function itself is
+# (easeOutElastic costs the same as linear).  A table is used just like
+# the function it samples:
+#
+#   curve = easing.table(pytweening.easeOutElastic)
+#   curve(0.25)
+
+resolution = 1024 # Default samples per table (over 0-1 inclusive)
+
+tables = {} # (function, resolution) -> table, so each is built once
+
+
+# Returns a function of t giving function's value at the nearest sample
+# to t (t outside 0-1 is clamped).  A plain closure rather than an object
+# with __call__, as that's the cheaper call in CPython.
+def table(function, steps=resolution):
+	key = (function, steps)
+	if key in tables: return tables[key]
+	last   = steps - 1
+	values = [function(i / float(last)) for i in range(steps)]
+	def curve(t):
+	  i = int(t * last + 0.5)
+	  if i < 0:    return values[0]
+	  if i > last: return values[-1]
+	  return values[i]
+	curve.values = values # Samples, e.g. for inspection
+	tables[key] = curve
+	return curve
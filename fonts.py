@@ -0,0 +1,151 @@
+# Font helpers for keyb.py's status text.
+#
+# load_font() stands in for pygame.font.SysFont(), which scans every
+# installed font (fc-list on Linux) each time it's first called.  The
+# font file SysFont picks for a given family, size and boldness is
+# recorded in a small JSON cache file, and later starts open that file
+# directly.  Entries whose font file has gone are looked up again.
+#
+# GlyphAtlas renders each character of a font once, into a single
+# Surface, so strings can then be drawn by blitting glyphs from it rather
+# than calling Font.render() (and allocating a new Surface) every frame.
+# TextLine builds on it for status lines of fixed labels and changing
+# fields, redrawing only the fields whose value changed.
+
+import json
+import os
+import os.path
+import pygame
+
+fontCachePath = 'fonts.cache' # Family/size/bold -> font file, see load_font()
+
+
+def load_font(family, size, bold=False):
+	key = '%s/%d/%s' % (family, size, 'bold' if bold else 'regular')
+	try:
+	  with open(fontCachePath) as f:
+	    cache = json.load(f)
+	except (IOError, ValueError):
+	  cache = {}
+	entry = cache.get(key)
+	if entry and (entry[0] is None or os.path.exists(entry[0])):
+	  path, fakeBold = entry
+	else:
+	  # Let SysFont do the lookup, but have it report what it found
+	  found = []
+	  def constructor(path, size, bold, italic):
+	    found.append((path, bold))
+	  pygame.font.SysFont(family, size, bold, False, constructor)
+	  path, fakeBold = found[0] # path None = pygame's default font
+	  cache[key] = [path, fakeBold]
+	  try:
+	    with open(fontCachePath, 'w') as f:
+	      json.dump(cache, f, indent=1, sort_keys=True)
+	  except IOError:
+	    pass # Read-only; just look it up again next time
+	font = pygame.font.Font(path, size)
+	font.set_bold(fakeBold) # Emulated bold, where there's no bold face
+	return font
+
+
+# Glyphs for the printable ASCII characters of font, antialiased in color,
+# side by side in one Surface.  Characters outside that set are drawn as
+# '?'.  Glyphs are placed by their own advance, without kerning, which is
+# exact for the monospaced fonts this is meant for.
+
+class GlyphAtlas:
+
+	def __init__(self, font, color, chars=None):
+	  if chars is None: chars = ''.join(chr(c) for c in range(32, 127))
+	  self.height = font.get_height()
+	  self.rects  = {} # Character -> Rect in atlas
+	  self.cell   = 0  # Widest glyph, for fixed-width layout
+	  x = 0
+	  for c in chars:
+	    w = font.size(c)[0]
+	    self.rects[c] = pygame.Rect(x, 0, w, self.height)
+	    self.cell = max(self.cell, w)
+	    x += w
+	  self.atlas = pygame.Surface((max(x, 1), self.height), pygame.SRCALPHA, 32)
+	  for c in chars:
+	    self.atlas.blit(font.render(c, True, color), self.rects[c])
+	  if pygame.display.get_surface():
+	    self.atlas = self.atlas.convert_alpha() # Display's format, faster blits
+
+	def rect(self, c):
+	  return self.rects.get(c) or self.rects.get('?')
+
+	def size(self, text):
+	  return sum(self.rect(c).width for c in text), self.height
+
+	# Draw text with its top left at pos; returns the area covered
+	def draw(self, surface, text, pos):
+	  x, y = pos
+	  for c in text:
+	    r = self.rect(c)
+	    surface.blit(self.atlas, (x, y), r)
+	    x += r.width
+	  return pygame.Rect(pos, (x - pos[0], self.height))
+
+
+# A line of text in fixed-width cells (glyphs.cell wide), made of fixed
+# label strings and fields of a given number of characters, e.g.
+#   TextLine(glyphs, (0, 0), ['FPS: ', 6, '  TIME: ', 6])
+# Every piece has a fixed place on screen, so a field whose value changes
+# covers the same cells as before and is the only part to redraw.  Field
+# values are right-aligned; one too long for its field widens it, moving
+# the pieces after it along (see set()).
+
+class TextLine:
+
+	def __init__(self, glyphs, pos, layout):
+	  self.glyphs = glyphs
+	  self.pieces = [] # [Rect, text] per label & field, left to right
+	  self.fields = [] # Indices into pieces of the fields
+	  x, y = pos
+	  for item in layout:
+	    if isinstance(item, int):
+	      self.fields.append(len(self.pieces))
+	      text = ' ' * item
+	    else:
+	      text = item
+	    w = len(text) * glyphs.cell
+	    self.pieces.append([pygame.Rect(x, y, w, glyphs.height), text])
+	    x += w
+	  self.rect = pygame.Rect(pos, (x - pos[0], glyphs.height))
+
+	# Set the fields' values (strings, in order).  Returns the Rects of
+	# fields whose text changed, to be repainted and passed to draw().  A
+	# value too long for its field widens it (for good), moving what
+	# follows along; everything from that field to the line's end is
+	# returned then.
+	def set(self, values):
+	  changed = []
+	  for i, value in zip(self.fields, values):
+	    rect, old = self.pieces[i]
+	    text      = value.rjust(len(old))
+	    if text == old: continue
+	    self.pieces[i][1] = text
+	    if len(text) > len(old):
+	      grow    = (len(text) - len(old)) * self.glyphs.cell
+	      rect.w += grow
+	      for piece in self.pieces[i + 1:]:
+	        piece[0].x += grow
+	      self.rect.w += grow
+	      changed.append(pygame.Rect(rect.x, rect.y,
+	        self.rect.right - rect.x, rect.h))
+	    else:
+	      changed.append(rect)
+	  return changed
+
+	# Draw the pieces overlapping area (whole line if None), which the
+	# caller has cleared to background, clipped to it if partial.
+	def draw(self, surface, area=None):
+	  cell = self.glyphs.cell
+	  for rect, text in self.pieces:
+	    if area is not None and not rect.colliderect(area): continue
+	    x = rect.x
+	    for c in text:
+	      if c != ' ':
+	        surface.blit(self.glyphs.atlas, (x, rect.y), self.glyphs.rect(c))
+	      x += cell
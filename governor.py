@@ -0,0 +1,58 @@
+# Frame-rate governor: paces a pygame main loop at a rate chosen by what's
+# on screen, instead of one hardcoded FPS.  The loop reports its state
+# each frame (e.g. 'idle', 'keys', 'overlay', 'particles'), each with a
+# target rate, and calls tick() in place of Clock.tick(FPS).
+#
+# If frames take longer to draw than the target rate allows, the rate is
+# lowered to what the measured frame time can sustain (with some slack),
+# so the loop degrades evenly rather than stuttering; it returns to the
+# target by itself once frames get cheaper.  A state's rate may be None,
+# meaning the loop isn't paced at all (e.g. it blocks waiting for input).
+
+
+class Governor:
+
+	def __init__(self, clock, rates, minRate=10):
+	  self.clock   = clock   # pygame.time.Clock the loop runs on
+	  self.rates   = rates   # State name -> target frames/second (or None)
+	  self.minRate = minRate # Never back off below this
+	  self.state   = None
+	  self.work    = 0.0     # Average time (ms) spent drawing a frame
+	  self.smooth  = 0.1     # Weight of latest frame in that average
+	  self.slack   = 1.2     # Budget headroom over measured frame time
+
+	def set_state(self, state):
+	  self.state = state
+
+	# Frames/second to run at now: the state's rate, less if frames are
+	# taking too long for it.  None if the loop isn't to be paced.
+	def target(self):
+	  rate = self.rates.get(self.state)
+	  if rate is None or self.work <= 0: return rate
+	  return max(min(rate, self.minRate), min(rate, int(1000 / (self.work * self.slack))))
+
+	# Time available for a frame (ms) at the current target
+	def budget(self):
+	  rate = self.target()
+	  return 1000.0 / rate if rate else None
+
+	# Wait out the rest of the frame; returns ms since the last tick, as
+	# Clock.tick() does.  Unpaced frames (e.g. those that waited for
+	# input) aren't counted in the frame time average.
+	def tick(self):
+	  rate = self.target()
+	  ms   = self.clock.tick(rate or 0)
+	  if rate:
+	    raw       = self.clock.get_rawtime() # Frame's own drawing time
+	    self.work = raw if self.work <= 0 else (
+	      self.work + (raw - self.work) * self.smooth)
+	  return ms
+
+	# Current figures, e.g. for a status line or log
+	def stats(self):
+	  return { 'state' : self.state,
+	           'target': self.rates.get(self.state),
+	           'rate'  : self.target(),
+	           'fps'   : self.clock.get_fps(),
+	           'work'  : self.work,
+	           'budget': self.budget() }
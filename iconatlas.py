@@ -0,0 +1,86 @@
+# Icon atlas: packs every PNG in an icons directory into a single image
+# plus a JSON index of icon name -> sub-rect, so keyb.py can populate its
+# Icons with one file decode and subsurfaces instead of opening and
+# inflating each small PNG in turn.  Build it offline whenever icons are
+# added or edited:
+#
+#   python iconatlas.py [icons directory ...]
+#
+# which writes e.g. icons.atlas.png and icons.atlas.json alongside the
+# 'icons' directory.  Icons whose PNG changed after the atlas was built
+# (or that aren't in it) are still loaded from their PNG by keyb.py.
+
+import fnmatch
+import json
+import os
+import os.path
+import sys
+import pygame
+
+atlasWidth = 1024 # Width of atlas image (pixels); height grows to fit
+
+
+def atlas_paths(iconPath):
+	base = os.path.normpath(iconPath)
+	return base + '.atlas.png', base + '.atlas.json'
+
+
+# Pack icons with a simple shelf packer: tallest first, left to right in
+# rows ('shelves') as tall as the first icon placed in them.
+def build_atlas(iconPath):
+	images = []
+	for file in sorted(os.listdir(iconPath)):
+	  if fnmatch.fnmatch(file, '*.png'):
+	    path = os.path.join(iconPath, file)
+	    img  = pygame.image.load(path).convert(24)
+	    images.append((file.split('.')[0], os.stat(path).st_mtime, img))
+	images.sort(key=lambda i: -i[2].get_height())
+	index = {}
+	x = y = shelf = 0
+	for name, mtime, img in images:
+	  w, h = img.get_size()
+	  if x + w > atlasWidth:
+	    x, y, shelf = 0, y + shelf, 0
+	  if shelf == 0: shelf = h
+	  index[name] = { 'rect': [x, y, w, h], 'mtime': mtime }
+	  x += w
+	atlas = pygame.Surface((atlasWidth, y + shelf), 0, 24)
+	for name, mtime, img in images:
+	  atlas.blit(img, index[name]['rect'][0:2])
+	imagePath, indexPath = atlas_paths(iconPath)
+	pygame.image.save(atlas, imagePath)
+	with open(indexPath, 'w') as f:
+	  json.dump(index, f, indent=1, sort_keys=True)
+	return len(index)
+
+
+# Load the atlas for iconPath.  Returns the (24-bit) atlas Surface and a
+# dict of icon name -> pygame.Rect for the icons that are still current
+# (PNG unchanged since the atlas was built), or (None, {}) if there is no
+# usable atlas.  Needs pygame.display initialized, for Surface.convert().
+def load_atlas(iconPath):
+	imagePath, indexPath = atlas_paths(iconPath)
+	try:
+	  with open(indexPath) as f:
+	    index = json.load(f)
+	  atlas = pygame.image.load(imagePath).convert(24)
+	except (IOError, ValueError, pygame.error):
+	  return None, {}
+	rects = {}
+	for name, entry in index.iteritems():
+	  name = name.encode('utf-8') # Match (byte string) file names
+	  try:
+	    mtime = os.stat(os.path.join(iconPath, name + '.png')).st_mtime
+	  except OSError:
+	    continue # PNG removed since build
+	  if mtime == entry['mtime']:
+	    rects[name] = pygame.Rect(entry['rect'])
+	return atlas, rects
+
+
+if __name__ == '__main__':
+	os.environ.setdefault('SDL_VIDEODRIVER', 'dummy') # No window needed
+	pygame.display.init() # For Surface.convert()
+	for iconPath in sys.argv[1:] or ['icons']:
+	  n = build_atlas(iconPath)
+	  print('%s: %d icons -> %s' % (iconPath, n, atlas_paths(iconPath)[0]))
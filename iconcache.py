@@ -0,0 +1,125 @@
+# Preconverted icon cache: keeps Icons' bitmaps, already converted to the
+# display's pixel format, in a single file keyed by source PNG path, mtime
+# and depth.  A warm start memory-maps the file and copies pixels straight
+# into Surfaces, skipping both PNG inflate and format conversion.
+# (pygame.image.frombuffer() has no 16-bit formats, so the mapped bytes
+# are written into a new Surface's buffer rather than wrapped.)
+#
+# Entries may also be stored at a given (scaled) size, as in the icon packs
+# built by iconpack.py; the size is then part of the key.
+#
+# File layout: magic, index length, pickled index, then pixel data.  The
+# index maps (path, mtime, depth[, size]) -> (offset, size, pitch, masks),
+# offset being relative to the start of the pixel data.
+
+import cPickle as pickle
+import mmap
+import os
+import struct
+import pygame
+
+MAGIC  = 'ICC1'
+HEADER = '<4sI'
+
+
+class IconCache:
+
+	def __init__(self, path, depth):
+	  self.path  = path  # Cache file
+	  self.depth = depth # Bits per pixel of cached Surfaces
+	  self.index = {}    # As stored in file
+	  self.map   = None  # mmap of file, if any
+	  self.data  = 0     # Offset of pixel data in map
+	  self.added = {}    # Key -> Surface, for those not in file yet
+	  self.open()
+
+	def open(self):
+	  try:
+	    with open(self.path, 'rb') as f:
+	      self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	    magic, n = struct.unpack_from(HEADER, self.map, 0)
+	    if magic != MAGIC: raise ValueError('not an icon cache')
+	    start      = struct.calcsize(HEADER)
+	    self.index = pickle.loads(self.map[start:start + n])
+	    self.data  = start + n
+	  except (EnvironmentError, ValueError, EOFError, struct.error,
+	          pickle.UnpicklingError):
+	    self.close() # Missing, empty or damaged; start afresh
+	    self.index = {}
+
+	# Cache key for src (scaled to size, if given), or None if src can't
+	# be read (e.g. deleted since), which is then never cached.
+	def key(self, src, size=None):
+	  try:
+	    key = (src, os.stat(src).st_mtime, self.depth)
+	  except OSError:
+	    return None
+	  return key if size is None else key + (tuple(size),)
+
+	# Surface for source file src (scaled to size, if given) from the
+	# cache, or None if it's not cached (or the PNG changed since).
+	def get(self, src, size=None):
+	  if not self.index: return None
+	  key   = self.key(src, size)
+	  if key is None: return None
+	  entry = self.index.get(key)
+	  if entry is None: return None
+	  offset, size, pitch, masks = entry
+	  surf = pygame.Surface(size, 0, self.depth, masks)
+	  if surf.get_pitch() != pitch: return None
+	  start = self.data + offset
+	  surf.get_buffer().write(self.map[start:start + pitch * size[1]], 0)
+	  return surf
+
+	# Add Surface surf (already in the cache's depth), loaded from src and
+	# scaled to size, if given.
+	def put(self, src, surf, size=None):
+	  key = self.key(src, size)
+	  if key is not None:
+	    self.added[key] = surf.copy() # Detach subsurfaces
+
+	# True if the PNG a key refers to is unchanged
+	def current(self, key):
+	  try:
+	    return os.stat(key[0]).st_mtime == key[1]
+	  except OSError:
+	    return False
+
+	# If anything new was added, rewrite the cache file with it and every
+	# entry already there that's still current (dropping stale ones).
+	def save(self):
+	  if not self.added: return
+	  items = dict((key, entry) for key, entry in self.index.iteritems()
+	               if self.current(key))
+	  items.update(self.added)
+	  index  = {}
+	  pixels = []
+	  offset = 0
+	  for key, item in items.iteritems():
+	    if isinstance(item, pygame.Surface):
+	      data  = item.get_buffer().raw
+	      entry = (offset, item.get_size(), item.get_pitch(), item.get_masks())
+	    else:
+	      start = self.data + item[0]
+	      data  = self.map[start:start + item[2] * item[1][1]]
+	      entry = (offset,) + item[1:]
+	    index[key] = entry
+	    pixels.append(data)
+	    offset += len(data)
+	  header = pickle.dumps(index, pickle.HIGHEST_PROTOCOL)
+	  self.close()
+	  tmp = self.path + '.tmp'
+	  with open(tmp, 'wb') as f:
+	    f.write(struct.pack(HEADER, MAGIC, len(header)))
+	    f.write(header)
+	    for data in pixels: f.write(data)
+	  if os.name == 'nt' and os.path.exists(self.path):
+	    os.remove(self.path) # No atomic replace on Windows
+	  os.rename(tmp, self.path)
+	  self.added = {}
+	  self.open()
+
+	def close(self):
+	  if self.map is not None:
+	    self.map.close()
+	    self.map = None
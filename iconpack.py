@@ -0,0 +1,118 @@
+# Icon pack builder: prescales icons to every key size the layouts use and
+# stores them, already dithered down to the display's format, in a pack
+# file that keyb.py reads in place of calling smoothscale for each static
+# key.  Run it offline after changing icons or key sizes:
+#
+#   python iconpack.py [-d depth] [icons directory ...] [layout.json ...]
+#
+# (defaults: 16 bits per pixel, 'icons' and every layout in 'layouts'); the
+# depth has to be the one keyb.py's display ends up with, as packed bitmaps
+# of any other depth are ignored.  This writes e.g.
+# icons.iconpack alongside the 'icons' directory.  The pack uses the
+# same file format as the preconverted icon cache (see iconcache.py),
+# keyed by source PNG, mtime, depth and size, so keys whose icon has
+# changed since are just scaled at runtime as before.
+#
+# Dithering needs NumPy (pygame.surfarray); without it, pixels are simply
+# truncated to the depth as Surface.convert() does.
+
+import getopt
+import glob
+import json
+import os
+import os.path
+import sys
+import pygame
+import iconcache
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+depth = 16 # Bits per pixel of display (and so of packed bitmaps), see -d
+
+# 4x4 ordered-dither (Bayer) thresholds, 0 to 15/16
+bayer = [[ 0,  8,  2, 10],
+         [12,  4, 14,  6],
+         [ 3, 11,  1,  9],
+         [15,  7, 13,  5]]
+
+
+def pack_path(iconPath):
+	return os.path.normpath(iconPath) + '.iconpack'
+
+
+# Icon name -> set of (w, h) the layout shows it at, following the same
+# geometry rules as keyb.py's compute_layout().
+def layout_sizes(layoutPath, sizes):
+	with open(layoutPath) as f:
+	  layout = json.load(f)
+	for row in layout['rows']:
+	  kw = row.get('width', layout['keyWidth'])
+	  kh = row.get('height', layout['keyHeight'])
+	  for k in row['keys']:
+	    size = (k.get('w', kw), k.get('h', kh))
+	    for field in ('bg', 'shift'):
+	      if k.get(field):
+	        sizes.setdefault(k[field].encode('utf-8'), set()).add(size)
+	return sizes
+
+
+# Size of one step of each of red, green & blue at depth, in 8-bit levels
+# (e.g. 8, 4, 8 for 16 bits per pixel)
+def channel_steps():
+	masks = pygame.Surface((1, 1), 0, depth).get_masks()[:3]
+	return [max(1, 256 >> bin(m).count('1')) for m in masks]
+
+
+# Reduce 24-bit Surface img to depth with an ordered dither, so smooth
+# gradients don't band.  Each channel gets a threshold of up to one step
+# at that depth before truncation.
+def dither(img):
+	steps = channel_steps()
+	if numpy is None or steps == [1, 1, 1]: return img.convert(depth)
+	w, h   = img.get_size()
+	px     = pygame.surfarray.array3d(img).astype(numpy.float32)
+	t      = numpy.tile(numpy.array(bayer, numpy.float32) / 16.0,
+	                    (w // 4 + 1, h // 4 + 1))[:w, :h]
+	for c, step in enumerate(steps):
+	  px[..., c] += t * step
+	out = pygame.Surface((w, h), 0, 24)
+	pygame.surfarray.blit_array(out, numpy.clip(px, 0, 255).astype(numpy.uint8))
+	return out.convert(depth)
+
+
+def build_pack(iconPath, sizes):
+	if os.path.exists(pack_path(iconPath)):
+	  os.remove(pack_path(iconPath)) # Start afresh, dropping unused sizes
+	pack  = iconcache.IconCache(pack_path(iconPath), depth)
+	count = 0
+	for name, wanted in sorted(sizes.iteritems()):
+	  # Path as keyb.py's icon_file() gives it, e.g. for 'icons/'
+	  src = os.path.join(os.path.normpath(iconPath), name + '.png')
+	  if not os.path.exists(src): continue
+	  img = pygame.image.load(src).convert(24)
+	  for size in sorted(wanted):
+	    pack.put(src, dither(pygame.transform.smoothscale(img, size)), size)
+	    count += 1
+	pack.save()
+	pack.close()
+	return count
+
+
+if __name__ == '__main__':
+	os.environ.setdefault('SDL_VIDEODRIVER', 'dummy') # No window needed
+	pygame.display.init() # For Surface.convert()
+	opts, args = getopt.getopt(sys.argv[1:], 'd:', ['depth='])
+	for opt, value in opts:
+	  if opt in ('-d', '--depth'): depth = int(value)
+	dirs    = [a for a in args if not a.endswith('.json')]
+	layouts = [a for a in args if a.endswith('.json')]
+	sizes   = {}
+	for layoutPath in layouts or sorted(glob.glob('layouts/*.json')):
+	  layout_sizes(layoutPath, sizes)
+	for iconPath in dirs or ['icons']:
+	  n = build_pack(iconPath, sizes)
+	  print('%s: %d %d-bit bitmaps -> %s%s' % (iconPath, n, depth,
+	    pack_path(iconPath), '' if numpy else ' (no NumPy, not dithered)'))
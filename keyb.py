@@ -1,11 +1,22 @@
 import atexit
+import easing
+import collections
 import cPickle as pickle
 import errno
 import fnmatch
+import fonts
+import governor
+import iconatlas
+import iconcache
 import io
+import json
+import keytable
+import multiprocessing.pool
 import os
 import os.path
+import pixelformat
 import pygame
+import Queue
 import stat
 import threading
 import time
@@ -19,16 +30,120 @@ from subprocess import call
 
 # Icon is a very simple bitmap class, just associates a name and a pygame
 # image (PNG loaded from icons directory) for each.
-# There isn't a globally-declared fixed list of Icons.  Instead, the list
-# is populated at runtime from the contents of the 'icons' directory.
+# There isn't a globally-declared fixed list of Icons.  Instead, the
+# icons registry is populated at runtime with the icons the active layout
+# references, plus any others asked for later.
+# Icons may instead be handed their 24-bit and display format bitmaps,
+# e.g. as subsurfaces of the prebuilt icon atlas (see iconatlas.py), or
+# just the latter from the preconverted icon cache (see iconcache.py).
 
 class Icon:
 
-	def __init__(self, name):
+	def __init__(self, name, original=None, bitmap=None):
 	  self.name = name
-	  self.originalbitmap = pygame.image.load(iconPath + '/' + name + '.png').convert(24)
+	  if bitmap is not None:
+	    self.originalbitmap = original
+	    self.bitmap         = bitmap
+	    return
+	  self.originalbitmap = pygame.image.load(icon_file(name)).convert(24)
 	  #self.bitmap = pygame.transform.smoothscale(self.originalbitmap, (self.originalbitmap.get_width(),self.originalbitmap.get_height()))
-	  self.bitmap = self.originalbitmap.convert(16)
+	  self.bitmap = display.convert(self.originalbitmap)
+
+
+
+# IconRegistry maps names to loaded Icons, loading them on demand via
+# loader (a function taking a name and returning an Icon, or None if
+# there's no such icon).  Buttons acquire() the Icons they show and
+# release() them when switched or discarded; an Icon no Button references
+# any more is dropped, freeing its bitmaps.  Icons that were loaded (by
+# get() or add()) but never acquired are dropped by sweep(), run on each
+# layout switch.  Lookups are a dict access, not a scan of every Icon.
+
+class IconRegistry:
+
+	def __init__(self, loader):
+	  self.loader = loader
+	  self.icons  = {} # Name -> Icon
+	  self.refs   = {} # Name -> number of acquire()s not yet released
+
+	def __contains__(self, name):
+	  return name in self.icons
+
+	def __len__(self):
+	  return len(self.icons)
+
+	# Icon by name (None if there's no such icon), loading it if needed
+	def get(self, name):
+	  icon = self.icons.get(name)
+	  if icon is None and name is not None:
+	    icon = self.loader(name)
+	    if icon:
+	      self.icons[name] = icon
+	      self.refs[name]  = 0
+	  return icon
+
+	# Register an Icon loaded elsewhere (e.g. in a batch)
+	def add(self, icon):
+	  self.icons[icon.name] = icon
+	  self.refs[icon.name]  = 0
+
+	def acquire(self, name):
+	  icon = self.get(name)
+	  if icon: self.refs[name] += 1
+	  return icon
+
+	def release(self, icon):
+	  if icon is None: return
+	  self.refs[icon.name] -= 1
+	  if self.refs[icon.name] <= 0:
+	    del self.icons[icon.name]
+	    del self.refs[icon.name]
+
+	# Drop every Icon no Button holds
+	def sweep(self):
+	  for name, refs in self.refs.items():
+	    if refs <= 0:
+	      del self.icons[name]
+	      del self.refs[name]
+
+
+
+# ScaleCache holds scaled copies of Icon bitmaps, keyed by (Icon, width,
+# height), so a Button that's animating doesn't rescale its Icon on every
+# frame.  Memory used by the cached pixels is capped at maxBytes; least
+# recently used sizes are evicted first.  hits & misses count lookups,
+# handy for tuning the cap.
+
+class ScaleCache:
+
+	def __init__(self, maxBytes):
+	  self.maxBytes = maxBytes
+	  self.bytes    = 0  # Pixel memory currently held
+	  self.hits     = 0
+	  self.misses   = 0
+	  self.entries  = collections.OrderedDict() # Oldest first
+
+	def get(self, icon, w, h):
+	  key = (icon, w, h)
+	  img = self.entries.pop(key, None)
+	  if img is not None:
+	    self.hits += 1
+	    self.entries[key] = img # Re-insert as most recently used
+	    return img
+	  self.misses += 1
+	  img  = pygame.transform.scale(icon.bitmap, (w, h))
+	  size = img.get_pitch() * h
+	  if size <= self.maxBytes:
+	    while self.bytes + size > self.maxBytes:
+	      old = self.entries.popitem(last=False)[1]
+	      self.bytes -= old.get_pitch() * old.get_height()
+	    self.entries[key] = img
+	    self.bytes += size
+	  return img
+
+	def clear(self):
+	  self.entries.clear()
+	  self.bytes = 0
 
 
 
@@ -47,24 +162,26 @@ class Icon:
 # may take input precedence (e.g. the Effect labels & buttons).
 # After Icons are loaded at runtime, a pass is made through the global
 # buttons[] list to assign the Icon objects (from names) to each Button.
+# A Button's animated size lives in the key table (see keytable.py), at
+# the Button's index, and is read through the w/h/animating properties.
 
-class Button:
+class Button(object):
 
 	def __init__(self, **kwargs):
 	  self.key      = None # the key
 	  self.color    = None # Background fill color, if any
 	  self.iconBg   = None # Background Icon (atop color fill)
-	  self.staticBg = None # 
-	  self.animating= False
+	  self.staticBg = None # iconBg prescaled to layout size
+	  self.index    = None # Position in keyTable, set by index_layout()
 	  self.iconFg   = None # Foreground Icon (atop background)
 	  self.bg       = None # Background Icon name
 	  self.fg       = None # Foreground Icon name
 	  self.callback = None # Callback function
 	  self.value    = None # Value passed to callback
-	  self.w        = None
-	  self.h        = None
-	  self.shift    = None
-	  self.shiftimg = None
+	  self.shift    = None # Shifted Icon name
+	  self.iconShift= None # Icon shown in place of iconBg while shifted
+	  self.shiftimg = None # iconShift prescaled to layout size
+	  self.drawn    = None # (x, y, w, h, shifted, animating) when last drawn
 	  for key, value in kwargs.iteritems():
 	    if   key == 'color': self.color    = value
 	    elif key == 'bg'   : self.bg       = value
@@ -75,6 +192,15 @@ class Button:
 	    elif key == 'shift': self.shift    = value
 
 
+	@property
+	def w(self): return keyTable.cw[self.index]
+
+	@property
+	def h(self): return keyTable.ch[self.index]
+
+	@property
+	def animating(self): return keyTable.moving[self.index]
+
 	def selected(self, pos):
 	  x1 = self.rect[0]
 	  y1 = self.rect[1]
@@ -88,40 +214,115 @@ class Button:
 	    return True
 	  return False
 
-	def draw(self, screen):
-	  if self.shiftimg is None and self.shift is not None:
-	    self.shiftimg = pygame.image.load(iconPath + '/' + self.shift + '.png').convert(16)
-	    self.shiftimg = pygame.transform.scale(self.shiftimg, (self.w,self.h))
+	# Prescale the idle images (normal and shifted) to the layout size, so
+	# nothing gets loaded or scaled when the Button is first drawn.
+	def prepare(self):
+	  size = (self.rect[2], self.rect[3])
+	  self.staticBg = static_image(self.iconBg, size)
+	  self.shiftimg = static_image(self.iconShift, size)
+
+	# rest=True draws the idle Button at its layout size, as composited
+	# into the cached keyboard layers; shifted overrides the shift state.
+	def draw(self, screen, rest=False, shifted=None):
+	  if rest: w, h, animating = self.rect[2], self.rect[3], False
+	  else:    w, h, animating = self.w, self.h, self.animating
+	  if shifted is None: shifted = shift
 	  if self.color:
-	    screen.fill(self.color, self.rect)
+	    screen.fill(self.color, (self.rect[0], self.rect[1], w, h))
 	  if self.iconBg:
-	    if shift and self.shift is not None:
+	    if shifted and self.shiftimg:
 	      img = self.shiftimg
+	    elif animating:
+	      img = scaledFrames.get(self.iconBg, w, h)
 	    else:
-	      if self.staticBg is None:
-	        self.staticBg = pygame.transform.smoothscale(self.iconBg.bitmap.convert(24), (self.w,self.h)).convert(16)
-	      if self.animating:
-	        img = pygame.transform.scale(self.iconBg.bitmap, (self.w,self.h))
-	      else:
-	        img = self.staticBg
+	      img = self.staticBg
 	    #img = self.iconBg.bitmap
 	    #img.set_alpha(255)
 	    screen.blit(img,(self.rect[0],self.rect[1]))
 	  if self.iconFg:
-	    img = pygame.transform.scale(self.iconFg.bitmap, (self.w,self.h))
+	    img = scaledFrames.get(self.iconFg, w, h)
 	    #img.set_alpha(255)
 	    screen.blit(img,
 	      (self.rect[0],
 	       self.rect[1]))
 
+	# Screen area covered by the Button at its current (animated) size.
+	def area(self):
+	  return pygame.Rect(self.rect[0], self.rect[1], self.w, self.h)
+
+	# Damage tracking: compare what the Button would draw now against what
+	# it drew last time, and return the rect(s) that need repainting (old
+	# and new extent), or an empty list if it would draw identically.
+	def damage(self):
+	  state = (self.rect[0], self.rect[1], self.w, self.h,
+	           shift and self.shiftimg is not None, self.animating)
+	  if state == self.drawn:
+	    return []
+	  rects = [self.area()]
+	  if self.drawn is not None:
+	    rects.append(pygame.Rect(self.drawn[0:4]))
+	  self.drawn = state
+	  return rects
+
+	# Switch the background Icon at runtime
 	def setBg(self, name):
-	  if name is None:
-	    self.iconBg = None
-	  else:
-	    for i in icons:
-	      if name == i.name:
-	        self.iconBg = i
-	        break
+	  old         = self.iconBg
+	  self.bg     = name
+	  self.iconBg = icons.acquire(name)
+	  icons.release(old)
+	  self.prepare()
+	  self.repaint()
+
+	# After the Button's images changed: redraw it, idle, into the cached
+	# keyboard layers (if they're current; else they're rebuilt anyway),
+	# and have it repainted on screen.
+	def repaint(self):
+	  self.drawn = None # Damaged
+	  if keyboardBgKey == (iconPath, layoutSerial):
+	    for shifted in (False, True):
+	      self.draw(keyboardLayers[shifted], rest=True, shifted=shifted)
+
+	# Acquire whichever of the named Icons are loaded and not yet held
+	def resolveIcons(self):
+	  if self.iconBg    is None and self.bg    in icons:
+	    self.iconBg    = icons.acquire(self.bg)
+	  if self.iconFg    is None and self.fg    in icons:
+	    self.iconFg    = icons.acquire(self.fg)
+	  if self.iconShift is None and self.shift in icons:
+	    self.iconShift = icons.acquire(self.shift)
+
+	# Release the Icons this Button holds (e.g. when its layout is dropped)
+	def releaseIcons(self):
+	  for icon in (self.iconBg, self.iconFg, self.iconShift):
+	    icons.release(icon)
+	  self.iconBg = self.iconFg = self.iconShift = None
+
+
+
+# HitGrid finds the Button under a screen position (e.g. a tap) without
+# testing every Button: the screen is split into square cells, each
+# listing the Buttons whose layout rect overlaps it, in buttons[] order.
+# So the first Button listed that contains the position is the one that
+# takes the input, as per the stacking rules above.
+
+class HitGrid:
+
+	def __init__(self, buttons, cellSize=64):
+	  self.cellSize = cellSize
+	  self.cells    = {} # (column, row) -> Buttons overlapping that cell
+	  for b in buttons:
+	    r = b.rect
+	    if r.w <= 0 or r.h <= 0: continue
+	    for col in range(r.left // cellSize, (r.right - 1) // cellSize + 1):
+	      for row in range(r.top // cellSize, (r.bottom - 1) // cellSize + 1):
+	        self.cells.setdefault((col, row), []).append(b)
+
+	# Topmost (first) Button at pos, or None
+	def hit(self, pos):
+	  for b in self.cells.get((pos[0] // self.cellSize,
+	                           pos[1] // self.cellSize), ()):
+	    if b.rect.collidepoint(pos): return b
+	  return None
 
 
 # UI callbacks -------------------------------------------------------------
@@ -140,210 +341,129 @@ sizeMode        =  0      # Image size; default = Large
 fxMode          =  0      # Image effect; default = Normal
 isoMode         =  0      # ISO settingl default = Auto
 iconPath        = 'icons' # Subdirectory containing UI bitmaps (PNG format)
+iconWorkers     = min(4, multiprocessing.cpu_count()) # Threads decoding
+                          # icon PNGs at startup (1 = serial)
 saveIdx         = -1      # Image index for saving (-1 = none set yet)
 loadIdx         = -1      # Image index for loading
 scaled          = None    # pygame Surface w/last-loaded image
 
 shift           = False
+scaleCacheSize  = 8 << 20 # Memory cap (bytes) for cached animation frames
+scaledFrames    = ScaleCache(scaleCacheSize)
+damageTracking  = True    # Repaint & push only changed screen areas
+formatAudit     = False   # On exit, list cached Surfaces not in display
+                          # format (see format_report())
+idleTimeout     = 1000    # When nothing's animating, sleep until an event
+                          # or this many ms (0 = never idle), see idle_wait()
+pulseSize       = 50      # Pixels a held key grows by at the peak of its pulse
+pulseTime       = 1000    # ms per grow & shrink cycle of a held key
+pulseCurve      = easing.table(pytweening.linear) # Sampled, see easing.py
+releaseTime     = 250     # ms for a released key to settle back to size
+releaseCurve    = easing.table(pytweening.easeOutQuad)
+keyArrays       = False   # Animate keys with NumPy (see keytable.py); only
+                          # faster with ~15 or more animating at once
+overlayCurve    = easing.table(pytweening.linear) # Color-cycle tint
+tintSteps       = 5       # Tint colors per 1 s cycle; each change of tint
+                          # repaints the whole screen, see run_frame()
+idleTint        = False   # Keep stepping the tint while idle, at the cost
+                          # of a full repaint (and wakeup) per step; off, it
+                          # holds its color until there's input again
+keyTable        = None    # Key sizes & animations, see load_layout()
+frameRates      = { 'idle'   : None, # Frames/second by frame_state(); idle
+                    'keys'   : 60,   # frames wait for input instead
+                    'overlay': 30 }
+IDLEEVENT       = USEREVENT # Timer event ending an idle wait
+renderThread    = False   # Draw frames on a thread of their own, leaving
+                          # the main thread to take input (see input_loop());
+                          # off by default, as SDL 1.2 doesn't promise every
+                          # video driver can be drawn to from another thread
+inputQueue      = collections.deque() # (time, event) from input thread
+inputReady      = threading.Event()   # Set when inputQueue gets an event
+frameLock       = threading.Lock()    # Held while a frame is drawn
+FINGERDOWN      = getattr(pygame, 'FINGERDOWN', -1) # Touch events, where
+FINGERUP        = getattr(pygame, 'FINGERUP',   -1) # pygame has them
+layoutPath      = 'layouts/keyboard.json' # Active keyboard layout file
+layoutMtime     = None    # Modification time of layoutPath when loaded
+layoutCheck     = 1000    # Interval (ms) between checks for layout edits
+layout          = None    # Parsed layout file (geometry & key definitions)
+layoutSerial    =  0      # Bumped whenever the layout is recomputed
+keyRects        = []      # Layout table: pygame.Rect per Button, as buttons[]
+keyboardLayers  = [None, None] # Cached Surfaces w/all Buttons drawn idle,
+                          # unshifted & shifted
+keyboardBgKey   = None    # (iconPath, layoutSerial) layers were built for
 
-icons = [] # This list gets populated at startup
-
-# buttons[] is a list of lists; each top-level list element corresponds
-# to one screen mode (e.g. viewfinder, image playback, storage settings),
-# and each element within those lists corresponds to one UI button.
-# There's a little bit of repetition (e.g. prev/next buttons are
-# declared for each settings screen, rather than a single reusable
-# set); trying to reuse those few elements just made for an ugly
-# tangle of code elsewhere.
-
-buttonsold = [
-   #row 1
-   [Button( bg='adobe_Ai'),
-   Button( bg='adobe_Dw'),
-   Button( bg='adobe_Fl'),
-   Button( bg='adobe_Fw'),
-   Button( bg='adobe_Id'),
-   Button( bg='adobe_Ps'),
-   Button( bg='axialis'),
-   Button( bg='adobe_Ai'),
-   Button( bg='adobe_Dw'),
-   Button( bg='adobe_Fl'),
-   Button( bg='adobe_Fw'),
-   Button( bg='adobe_Id'),
-   Button( bg='adobe_Ps'),
-   Button( bg='axialis')
-   ],
-   
-   #row 2
-   [Button( bg='chrome'),
-   Button( bg='dropbox', key=pygame.K_1),
-   Button( bg='email', key=pygame.K_2),
-   Button( bg='explorer', key=pygame.K_3),
-   Button( bg='firefox', key=pygame.K_4),
-   Button( bg='flashget', key=pygame.K_5),
-   Button( bg='foobar', key=pygame.K_6),
-   Button( bg='chrome', key=pygame.K_7),
-   Button( bg='dropbox', key=pygame.K_8),
-   Button( bg='email', key=pygame.K_9),
-   Button( bg='explorer', key=pygame.K_0),
-   ],
-   
-   #row 3
-   [Button( bg='games'),
-   Button( bg='googleEarth', key=pygame.K_q),
-   Button( bg='handbrake', key=pygame.K_w),
-   Button( bg='mediaPlayer', key=pygame.K_e),
-   Button( bg='notepad', key=pygame.K_r),
-   Button( bg='opera', key=pygame.K_t),
-   Button( bg='safari', key=pygame.K_y),
-   Button( bg='games', key=pygame.K_u),
-   Button( bg='googleEarth', key=pygame.K_i),
-   Button( bg='handbrake', key=pygame.K_o),
-   Button( bg='mediaPlayer', key=pygame.K_p),
-   Button( bg='notepad'),
-   ],
-   
-   #row 4
-   [Button( bg='sonyericsson'),
-   Button( bg='totalCommander', key=pygame.K_a),
-   Button( bg='uTorrent', key=pygame.K_s),
-   Button( bg='vlcPlayer', key=pygame.K_d),
-   Button( bg='webcam', key=pygame.K_f),
-   Button( bg='xbmc', key=pygame.K_g),
-   Button( bg='safari', key=pygame.K_h),
-   Button( bg='sonyericsson', key=pygame.K_j),
-   Button( bg='totalCommander', key=pygame.K_k),
-   Button( bg='uTorrent', key=pygame.K_l),
-   Button( bg='vlcPlayer'),
-   Button( bg='webcam',),
-   ],
-   
-   #row 5
-   [Button( bg='adobe_Ai'),
-   Button( bg='adobe_Dw', key=pygame.K_z),
-   Button( bg='adobe_Fl', key=pygame.K_x),
-   Button( bg='adobe_Fw', key=pygame.K_c),
-   Button( bg='adobe_Id', key=pygame.K_v),
-   Button( bg='adobe_Ps', key=pygame.K_b),
-   Button( bg='axialis', key=pygame.K_n),
-   Button( bg='adobe_Ai', key=pygame.K_m),
-   Button( bg='adobe_Dw'),
-   Button( bg='adobe_Fl'),
-   Button( bg='adobe_Fw'),
-   Button( bg='adobe_Id'),
-   ],
-   
-   #row 6
-   [Button( bg='chrome'),
-   Button( bg='dropbox'),
-   Button( bg='email'),
-   Button( bg='explorer'),
-   Button( bg='firefox'),
-   Button( bg='flashget'),
-   Button( bg='foobar'),
-   Button( bg='chrome'),
-   ]
-   
-]
-
-buttons = [
-   #row 1
-   [Button( bg='escape'),
-   Button( bg='f1'),
-   Button( bg='f2'),
-   Button( bg='f3'),
-   Button( bg='f4'),
-   Button( bg='f5'),
-   Button( bg='f6'),
-   Button( bg='f7'),
-   Button( bg='f8'),
-   Button( bg='f9'),
-   Button( bg='f10'),
-   Button( bg='f11'),
-   Button( bg='f12'),
-   Button( bg='printscreen')
-   ],
-   
-   #row 2
-   [
-   Button( bg='~'),
-   Button( bg='1', key=pygame.K_1),
-   Button( bg='2', key=pygame.K_2),
-   Button( bg='3', key=pygame.K_3),
-   Button( bg='4', key=pygame.K_4),
-   Button( bg='5', key=pygame.K_5),
-   Button( bg='6', key=pygame.K_6),
-   Button( bg='7', key=pygame.K_7),
-   Button( bg='8', key=pygame.K_8),
-   Button( bg='9', key=pygame.K_9),
-   Button( bg='0', key=pygame.K_0),
-   Button( bg='-'),
-   Button( bg='+'),
-   Button( bg='oemclear'),
-   ],
-   
-   #row 3
-   [Button( bg='tab'),
-   Button( bg='q', shift = 'qu', key=pygame.K_q),
-   Button( bg='w', shift = 'wu', key=pygame.K_w),
-   Button( bg='e', shift = 'eu', key=pygame.K_e),
-   Button( bg='r', shift = 'ru', key=pygame.K_r),
-   Button( bg='t', shift = 'tu', key=pygame.K_t),
-   Button( bg='y', shift = 'yu', key=pygame.K_y),
-   Button( bg='u', shift = 'uu', key=pygame.K_u),
-   Button( bg='i', shift = 'iu', key=pygame.K_i),
-   Button( bg='o', shift = 'ou', key=pygame.K_o),
-   Button( bg='p', shift = 'pu', key=pygame.K_p),
-   Button( bg='['),
-   Button( bg=']'),
-   Button( bg='return'),
-   ],
-   
-   #row 4
-   [Button( bg='capital'),
-   Button( bg='a', shift = 'au', key=pygame.K_a),
-   Button( bg='s', shift = 'su', key=pygame.K_s),
-   Button( bg='d', shift = 'du', key=pygame.K_d),
-   Button( bg='f', shift = 'fu', key=pygame.K_f),
-   Button( bg='g', shift = 'gu', key=pygame.K_g),
-   Button( bg='h', shift = 'hu', key=pygame.K_h),
-   Button( bg='j', shift = 'ju', key=pygame.K_j),
-   Button( bg='k', shift = 'ku', key=pygame.K_k),
-   Button( bg='l', shift = 'lu', key=pygame.K_l),
-   Button( bg=';'),
-   Button( bg='#'),
-   Button( bg='#'),
-   Button( bg='#'),
-   ],
-   
-   #row 5
-   [Button( bg='lshiftkey'),
-   Button( bg='z', shift = 'zu', key=pygame.K_z),
-   Button( bg='x', shift = 'xu', key=pygame.K_x),
-   Button( bg='c', shift = 'cu', key=pygame.K_c),
-   Button( bg='v', shift = 'vu', key=pygame.K_v),
-   Button( bg='b', shift = 'bu', key=pygame.K_b),
-   Button( bg='n', shift = 'nu', key=pygame.K_n),
-   Button( bg='m', shift = 'mu', key=pygame.K_m),
-   Button( bg=','),
-   Button( bg='rshiftkey'),
-   Button( bg='up'),
-   Button( bg='forwardslash'),
-   ],
-   
-   #row 6
-   [Button( bg='lcontrolkey'),
-   Button( bg='lwin'),
-   Button( bg='alt'),
-   Button( bg='space'),
-   Button( bg='alt'),
-   Button( bg='left'),
-   Button( bg='down'),
-   Button( bg='right'),
-   ]
-   
-]
+icons      = None # IconRegistry, populated at startup (see load_icons())
+display    = None # PixelFormat of the screen (see pixelformat.py)
+iconCache  = None # Preconverted icon cache (see iconcache.py)
+iconPack   = None # Prescaled key bitmaps (see iconpack.py), same format
+atlas      = None # Icon atlas, 24-bit & 16-bit, if loaded
+atlas16    = None
+atlasRects = None # Icon name -> Rect in atlas; None until atlas loaded
+iconLock   = threading.Lock() # Held while using iconCache & atlas
+iconQueue  = Queue.Queue()    # (stream, name, Icon or None) loaded in
+                              # background, for main loop
+iconStream = 0    # Bumped for each layout's icon load; older streams'
+                  # results are dropped
+waiting    = {}   # Icon name -> Buttons still waiting for it to load
+placeholderColor = (48, 48, 48) # Key fill until its Icon has loaded
 
+# buttons[] is a list of lists, one per keyboard row, each holding that
+# row's Buttons left to right.  It is built from the layout file (see
+# load_layout()) rather than declared here, so layouts can be edited
+# and picked up while running.
+buttons   = []
+drawOrder = [] # Buttons in paint order, see load_layout()
+keyButtons = {} # pygame key code -> Buttons for that key, see load_layout()
+hitGrid    = None # HitGrid over Buttons' rects, see index_layout()
+touched    = {}   # Pointer (mouse or finger ID) -> Button it pressed
+
+
+# Icon's bitmap at a key's idle size: from the prebuilt icon pack (see
+# iconpack.py) if it has it, else smoothscaled here (from the 24-bit
+# original, where the Icon still has it).
+def static_image(icon, size):
+	if icon is None: return None
+	img = iconPack.get(icon_file(icon.name), size)
+	if img is None:
+	  src = icon.originalbitmap or icon.bitmap.convert(24)
+	  img = pygame.transform.smoothscale(src, size)
+	return display.convert(img)
+
+# Print the cached Surfaces that aren't in the display's pixel format, and
+# so get converted pixel by pixel each time they're blitted.
+def format_report():
+	surfaces = [('glyphs', glyphs.atlas)]
+	surfaces.extend(('keyboard layer %d' % i, layer)
+	  for i, layer in enumerate(keyboardLayers))
+	surfaces.extend(('icon ' + icon.name, icon.bitmap)
+	  for icon in icons.icons.values())
+	for b in drawOrder:
+	  surfaces.append(('key %s bg' % b.bg, b.staticBg))
+	  surfaces.append(('key %s shift' % b.shift, b.shiftimg))
+	surfaces.extend(('frame %s %dx%d' % (key[0].name, key[1], key[2]), img)
+	  for key, img in scaledFrames.entries.items())
+	lines = display.audit(surfaces)
+	print('Pixel format: %d of %d cached Surfaces need converting on blit' %
+	  (len(lines), len([s for name, s in surfaces if s is not None])))
+	for line in lines: print('  ' + line)
+
+# After the display's pixel format changed (e.g. a resize that got a new
+# mode), bring the cached Surfaces into the new format: Icons' bitmaps
+# and the glyphs are converted again (from the 24-bit originals where
+# kept), scaled frames dropped, and the keyboard layers rebuilt on the
+# next frame.  Buttons' prescaled images are remade by compute_layout().
+def reformat_surfaces():
+	global atlas16, keyboardBgKey
+	with iconLock:
+	  iconCache.depth = display.depth # Keys include the depth
+	  iconPack.depth  = display.depth
+	  if atlas: atlas16 = display.convert(atlas)
+	  for icon in icons.icons.values():
+	    icon.bitmap = display.convert(icon.originalbitmap or icon.bitmap)
+	glyphs.atlas = display.convert_alpha(glyphs.atlas)
+	scaledFrames.clear()
+	keyboardLayers[:] = [None, None]
+	keyboardBgKey     = None
 
 # Scan files in a directory, locating JPEGs with names matching the
 # software's convention (IMG_XXXX.JPG), returning a tuple with the
@@ -361,27 +481,417 @@ def imgRange(path):
 	  return None if min > max else (min, max)
 
 
-def draw_text(screen, font, text, surfacewidth, surfaceheight):
-	"""Center text in window
-	"""
-	fw, fh = font.size(text) # fw: font width,  fh: font height
-	surface = font.render(text, True, (0, 0, 255))
-	# // makes integer division in python3 
-	screen.blit(surface, (0,0))
-
-def apply_animation(b,keys,w,h, reverseanimation):
-    if keys is not None and b.key is not None and len(keys) > 0 and keys[b.key]:
-      b.animating = True
-      if reverseanimation:
-        b.w = w + int(pytweening.linear(1.0 - millis ) * 100)
-        b.h = h + int(pytweening.linear(1.0 - millis ) * 100)      
-      else:
-        b.w = w + int(pytweening.linear( (millis )) * 100)
-        b.h = h + int(pytweening.linear((millis )) * 100)
-    else:
-      b.h = h
-      b.w = w
-      b.animating = False
+# Layout files are JSON:
+#  - "left"/"top": position of the first row, "spacing": [horiz, vert] gap
+#    between keys/rows, "keyWidth"/"keyHeight": default key size
+#  - "rows": list of {"keys": [...], optional "width"/"height" defaults}
+#  - each key: "bg"/"fg" Icon names, optional "shift" Icon name, "key"
+#    pygame key constant name (e.g. "K_q"), optional "w"/"h" size and
+#    "gap" (extra space left of the key)
+# Keys in a row are placed left to right.  Icons are looked up by name in
+# the icons registry, so switching layouts doesn't reload those already
+# in use.
+def load_layout(path):
+	global layout, layoutMtime, buttons, drawOrder, keyTable, keyButtons
+	global keyRects, waiting
+	mtime = os.stat(path).st_mtime
+	with open(path) as f:
+	  spec = json.load(f)
+	# Icon names are matched against (byte string) icon file names
+	def name(n):
+	  return None if n is None else n.encode('utf-8')
+	rows = []
+	for row in spec['rows']:
+	  rows.append([Button(bg=name(k.get('bg')), fg=name(k.get('fg')),
+	    shift=name(k.get('shift')),
+	    key=getattr(pygame, k['key']) if 'key' in k else None)
+	    for k in row['keys']])
+	# Everything that can fail on a bad file is worked out before any of
+	# the current layout is touched, so a failed reload leaves it whole.
+	rects = layout_rects(spec, rows)
+	table = keytable.KeyTable([r for s in rects for r in s],
+	  (pulseTime, pulseSize, pulseCurve), (releaseTime, releaseCurve),
+	  keyArrays)
+	# Key events go straight to the Buttons for that key
+	keyMap = {}
+	for s in rows:
+	  for b in s:
+	    if b.key is not None: keyMap.setdefault(b.key, []).append(b)
+	pending, wait = assign_icons(rows)
+	try:
+	  for s, row in zip(rows, rects):
+	    for b, r in zip(s, row):
+	      b.rect = r
+	      b.prepare()
+	except Exception:
+	  for s in rows:
+	    for b in s:
+	      b.releaseIcons()
+	  icons.sweep()
+	  raise
+	old         = buttons
+	layout      = spec
+	layoutMtime = mtime
+	buttons     = rows
+	keyRects    = rects
+	keyTable    = table # Not the old Buttons' sizes & animations
+	keyButtons  = keyMap
+	waiting     = wait
+	touched.clear()
+	# Buttons in the order they're painted: last row first, and within
+	# each row last Button first, so the first Button ends up on top.
+	drawOrder = [b for s in reversed(buttons) for b in reversed(s)]
+	stream_pending(pending)
+	# Only now let go of the old layout's Icons, so shared ones are kept
+	for s in old:
+	  for b in s:
+	    b.releaseIcons()
+	icons.sweep() # And any loaded but never taken up
+	index_layout()
+
+# Reload the layout file if it was edited since it was loaded.  A file
+# that fails to parse is reported and the current layout kept.
+def check_layout():
+	global layoutMtime
+	try:
+	  mtime = os.stat(layoutPath).st_mtime
+	except OSError:
+	  return # Mid-save or removed; keep current layout
+	if mtime == layoutMtime:
+	  return
+	try:
+	  load_layout(layoutPath)
+	except (IOError, ValueError, KeyError, TypeError, AttributeError) as e:
+	  layoutMtime = mtime # Don't retry until the file changes again
+	  print('Layout %s not loaded: %s' % (layoutPath, e))
+
+# Assign Icons to Buttons (by name) once they're loaded
+# Only the icons the rows of Buttons name (bg, fg & shift) are loaded,
+# then each Button's names are resolved in a single pass.  Returns the
+# names still to be streamed in (see stream_pending()) and a map of those
+# to their Buttons, which are assigned them as they arrive (see
+# deliver_icons()); until then those Buttons show placeholderColor.
+def assign_icons(rows):
+	names = set()
+	for s in rows:
+	  for b in s:
+	    names.update((b.bg, b.fg, b.shift))
+	names.discard(None)
+	pending = load_icons(names)
+	wait    = {}
+	for s in rows:           # For each row of buttons...
+	  for b in s:            #  For each button in row...
+	    b.resolveIcons()
+	    for name in (b.bg, b.fg, b.shift):
+	      if name in pending: wait.setdefault(name, []).append(b)
+	    if b.bg in pending and b.color is None:
+	      b.color = placeholderColor
+	return pending, wait
+
+# Path of the named Icon's PNG, which is also its key in the icon cache
+# and icon pack (iconpack.py builds it the same way)
+def icon_file(name):
+	return os.path.join(os.path.normpath(iconPath), name + '.png')
+
+# Load Icons for the given names that aren't loaded yet.  Those in the
+# preconverted cache load right away; returns the set of the rest, to be
+# streamed in by stream_pending().
+def load_icons(names):
+	pending = set()
+	with iconLock:
+	  for name in names:
+	    if name in icons or not os.path.exists(icon_file(name)): continue
+	    bitmap = iconCache.get(icon_file(name))
+	    if bitmap: icons.add(Icon(name, None, display.convert(bitmap)))
+	    else:      pending.add(name)
+	return pending
+
+# Start a new stream of icons for the current layout: names pending come
+# in from a background thread (stream_icons()), so the keyboard can be
+# shown in the meantime.  Any earlier stream's results are dropped.
+def stream_pending(pending):
+	global iconStream
+	iconStream += 1
+	if pending:
+	  t = threading.Thread(target=stream_icons,
+	                       args=(sorted(pending), iconStream))
+	  t.daemon = True
+	  t.start()
+
+# Background loader: takes icons from the atlas where possible, decodes
+# the rest in parallel, and queues each for the main loop as it's ready,
+# tagged with its stream.  Newly converted icons are then saved to the
+# icon cache for next start.  iconLock is only held around each use of
+# the cache or atlas, so the main thread can load icons meanwhile.  Every
+# name gets a result, None if it couldn't be loaded, so none is waited
+# for forever.
+def stream_icons(names, stream):
+	left = set(names)
+	def deliver(name, icon):
+	  if icon:
+	    with iconLock: iconCache.put(icon_file(name), icon.bitmap)
+	  left.discard(name)
+	  iconQueue.put((stream, name, icon))
+	try:
+	  rest = []
+	  for name in names:
+	    with iconLock: icon = find_icon(name)
+	    if icon: deliver(name, icon)
+	    else:    rest.append(name)
+	  decode_icons(rest, deliver)
+	  with iconLock: iconCache.save()
+	finally:
+	  for name in sorted(left):
+	    iconQueue.put((stream, name, None))
+
+# Main loop side of stream_icons(): register newly arrived Icons and give
+# them to the Buttons waiting for them, patching the cached keyboard
+# layers (if current) rather than recompositing them.
+def deliver_icons():
+	while True:
+	  try:
+	    stream, name, icon = iconQueue.get_nowait()
+	  except Queue.Empty:
+	    return
+	  if stream != iconStream: continue # For a layout since replaced
+	  if icon is None:
+	    waiting.pop(name, None) # Failed; Buttons keep their placeholder
+	    continue
+	  if icon.name not in icons:
+	    icon.bitmap = display.convert(icon.bitmap) # In case format changed
+	    icons.add(icon)
+	  for b in waiting.pop(icon.name, ()):
+	    b.resolveIcons()
+	    if b.color is placeholderColor and b.iconBg: b.color = None
+	    b.prepare()
+	    b.repaint()
+
+# Load Icon 'name' for the icons registry (one at a time, on demand):
+# from the preconverted cache or atlas if possible, else its PNG.
+# Returns the Icon, or None if there's no such icon.
+def load_icon(name):
+	if not os.path.exists(icon_file(name)): return None
+	with iconLock:
+	  icon = find_icon(name)
+	  if icon is None:
+	    icon = Icon(name)
+	    iconCache.put(icon_file(name), icon.bitmap)
+	return icon
+
+# Icon 'name' from the preconverted icon cache if it's there, else from
+# the icon atlas (decoded on first use, if one was built and is current),
+# or None if it's in neither.
+def find_icon(name):
+	global atlas, atlas16, atlasRects
+	bitmap = iconCache.get(icon_file(name))
+	if bitmap: return Icon(name, None, display.convert(bitmap))
+	if atlasRects is None:
+	  atlas, atlasRects = iconatlas.load_atlas(iconPath)
+	  if atlas: atlas16 = display.convert(atlas)
+	r = atlasRects.get(name)
+	if r is None: return None
+	icon = Icon(name, atlas.subsurface(r), atlas16.subsurface(r))
+	iconCache.put(icon_file(name), icon.bitmap)
+	return icon
+
+# Decode the named icon PNGs on a pool of iconWorkers threads, passing
+# each name and resulting Icon (None if it failed) to deliver().  Workers
+# inflate each PNG to a raw RGB buffer (pygame releases the GIL while
+# decoding); the calling thread wraps those and does the pygame format
+# conversion as they arrive.
+# Prints the time taken against the summed per-icon decode & convert
+# times, i.e. what the serial path would take (overstated if there are
+# more workers than cores).
+def decode_icons(names, deliver):
+	if not names: return
+	def decode(name):
+	  start = time.time()
+	  try:
+	    img  = pygame.image.load(icon_file(name))
+	    data = pygame.image.tostring(img, 'RGB')
+	  except (pygame.error, EnvironmentError) as e:
+	    print('Icon %s not loaded: %s' % (name, e))
+	    return name, None, None, time.time() - start
+	  return name, img.get_size(), data, time.time() - start
+	start  = time.time()
+	serial = 0.0
+	count  = 0
+	pool   = None
+	if iconWorkers > 1:
+	  pool    = multiprocessing.pool.ThreadPool(iconWorkers)
+	  results = pool.imap(decode, names)
+	else:
+	  results = (decode(name) for name in names)
+	try:
+	  for name, size, data, elapsed in results:
+	    if data is None:
+	      deliver(name, None)
+	      continue
+	    t        = time.time()
+	    original = pygame.image.fromstring(data, size, 'RGB')
+	    deliver(name, Icon(name, original, display.convert(original)))
+	    serial  += elapsed + time.time() - t
+	    count   += 1
+	finally:
+	  if pool: pool.close()
+	wall = time.time() - start
+	print('Decoded %d icons in %.3fs on %d thread(s); serial %.3fs '
+	  '(%.1fx)' % (count, wall, max(iconWorkers, 1), serial,
+	  serial / wall if wall > 0 else 1.0))
+
+# Rects of the keys in layout spec, as a list per row, for the rows of
+# Buttons built from it.  Only works them out; nothing is assigned, so a
+# bad spec (e.g. a key of no width) raises before any layout is touched.
+def layout_rects(spec, rows):
+	spacinghor, spacingver = spec['spacing']
+	rects = []
+	top   = spec.get('top', 0)
+	for s, row in zip(rows, spec['rows']):
+	  kw  = row.get('width', spec['keyWidth'])
+	  kh  = row.get('height', spec['keyHeight'])
+	  lft = spec.get('left', 0)
+	  rowRects = []
+	  for b, k in zip(s, row['keys']):
+	    lft += k.get('gap', 0)
+	    r    = pygame.Rect(lft, top, k.get('w', kw), k.get('h', kh))
+	    if r.w <= 0 or r.h <= 0:
+	      raise ValueError('key %s is %dx%d' % (k.get('key'), r.w, r.h))
+	    rowRects.append(r)
+	    lft += r.w + spacinghor
+	  rects.append(rowRects)
+	  top += kh + spacingver
+	return rects
+
+# Layout engine: turn the layout's geometry into the keyRects table of
+# pygame.Rect objects, assigned to each Button's rect.  Run when a layout
+# is loaded and on resize only; the main loop just reads the table.
+def compute_layout():
+	global keyRects
+	keyRects = layout_rects(layout, buttons)
+	for s, row in zip(buttons, keyRects):
+	  for b, r in zip(s, row):
+	    b.rect = r
+	    b.prepare()
+	index_layout()
+
+# Point the key table, Buttons' indices and the hit grid at keyRects, as
+# just laid out
+def index_layout():
+	global layoutSerial, hitGrid
+	# Key table rows follow buttons[]: row by row, left to right
+	rects = [r for row in keyRects for r in row]
+	keyTable.resize(rects) # Keep animations running
+	for i, b in enumerate(b for s in buttons for b in s):
+	  b.index = i
+	hitGrid = HitGrid([b for s in buttons for b in s])
+	layoutSerial += 1
+
+# Composite every Button, idle, into the cached keyboard layers: one as
+# drawn normally and one with shifted Icons, so toggling shift just
+# swaps which layer is shown.  Rebuilt whenever icon theme or layout
+# changes.
+def build_background():
+	global keyboardBgKey
+	for shifted in (False, True):
+	  layer = keyboardLayers[shifted]
+	  if layer is None or layer.get_size() != screen.get_size():
+	    layer = keyboardLayers[shifted] = pygame.Surface(screen.get_size(), 0, screen)
+	  layer.fill(0)
+	  for b in drawOrder:
+	    b.draw(layer, rest=True, shifted=shifted)
+	keyboardBgKey = (iconPath, layoutSerial)
+
+# Paint the keyboard within area: the cached idle layer, then only the
+# Buttons that are animating.  Idle Buttons stacked above an animating one
+# that they overlap are drawn again so stacking order is preserved.
+def draw_keys(screen, area):
+	screen.blit(keyboardLayers[shift], area.topleft, area)
+	above = []
+	for b in drawOrder:
+	  if b.animating:
+	    r = b.area()
+	    if area.colliderect(r):
+	      b.draw(screen)
+	      above.append(r)
+	  elif above and b.area().collidelist(above) >= 0:
+	    b.draw(screen)
+
+# Merge overlapping rects so each damaged pixel is repainted (and pushed
+# to the display) only once per frame.
+def merge_rects(rects):
+	merged = []
+	for r in rects:
+	  r = pygame.Rect(r)
+	  if r.w <= 0 or r.h <= 0: continue
+	  i = r.collidelist(merged)
+	  while i >= 0:
+	    r.union_ip(merged.pop(i))
+	    i = r.collidelist(merged)
+	  merged.append(r)
+	return merged
+
+# What the next frame has to show, for the frame-rate governor:
+#  'keys'    - Buttons animating
+#  'overlay' - Icons still to arrive, a repaint due (e.g. the color-cycle
+#              tint stepping on) or damage tracking off
+#  'idle'    - nothing before the next event (or tint step, if idleTint),
+#              see idle_wait()
+def frame_state():
+	if keyTable.animating(): return 'keys'
+	if idleTimeout <= 0 or fullRedraw or waiting or not damageTracking:
+	  return 'overlay'
+	return 'idle'
+
+# Longest an idle wait may last (ms): idleTimeout, so the status line and
+# layout checks still run now and then, or less if idleTint and the tint
+# steps on sooner.
+def idle_timeout():
+	if not idleTint: return idleTimeout
+	period = 1000.0 / tintSteps
+	return min(idleTimeout, int(period - time.time() * 1000 % period) + 1)
+
+# Sleep until the next event, or idle_timeout() ms at most.  (pygame's
+# event.wait() has no timeout, so a timer event stands in for one.)
+# Returns the event that ended the wait, stamped with when it arrived, as
+# a list of (time, event) to process ahead of the queue.
+def idle_wait():
+	pygame.time.set_timer(IDLEEVENT, idle_timeout())
+	event = pygame.event.wait()
+	when  = pygame.time.get_ticks()
+	pygame.time.set_timer(IDLEEVENT, 0)
+	pygame.event.clear(IDLEEVENT) # In case it fired meanwhile
+	return [] if event.type == IDLEEVENT else [(when, event)]
+
+# Key animation: pressing a key starts its Buttons pulsing, from the
+# moment of the press; releasing eases them back from wherever they'd got
+# to.  The key table works out all keys' sizes at once each frame.
+# 'when' is the time (ms, as pygame.time.get_ticks()) of the input event.
+def press_key(key, when):
+	for b in keyButtons.get(key, ()):
+	  keyTable.press(b.index, when)
+
+def release_key(key, when):
+	for b in keyButtons.get(key, ()):
+	  keyTable.release(b.index, when)
+
+# Taps: a Button pressed by mouse or finger animates as if its key was
+# pressed, and runs its callback (if any); it's released when that
+# pointer lifts.
+def touch_down(pointer, pos, when):
+	b = hitGrid.hit(pos)
+	if b is None: return
+	touch_up(pointer, when)
+	touched[pointer] = b
+	keyTable.press(b.index, when)
+	b.selected(pos)
+
+def touch_up(pointer, when):
+	b = touched.pop(pointer, None)
+	if b is not None:
+	  keyTable.release(b.index, when)
+
+def apply_animation():
+	keyTable.update(pygame.time.get_ticks())
 
 # Initialization -----------------------------------------------------------
 
@@ -410,210 +920,227 @@ if pygame.display.Info().current_h == 480:
 else:
   screen = pygame.display.set_mode((1300,540),pygame.HWSURFACE,16)
 screenPrescaled = screen
-overlay = pygame.Surface( screen.get_size(), pygame.SRCALPHA, 16)
+# Every cached Surface is converted to the display's actual pixel format
+display = pixelformat.PixelFormat(screen)
 #screenPrescaled = pygame.Surface((800, 480), flags=pygame.HWSURFACE, depth=16)
 clock=pygame.time.Clock()
 windoww = pygame.display.Info().current_w
 windowh = pygame.display.Info().current_h
 pygame.mouse.set_visible(False)
-font = pygame.font.SysFont('mono', 24, bold=True)
+# Font file is looked up once and cached (see fonts.py), and the status
+# line is drawn from prerendered glyphs, a field at a time
+font       = fonts.load_font('mono', 24, bold=True)
+glyphs     = fonts.GlyphAtlas(font, (0, 0, 255))
+statusLine = fonts.TextLine(glyphs, (0, 0),
+  ['FPS: ', 6, ' ' * 5 + 'TIME: ', 8, ' SECONDS'])
 pygame.display.set_caption('')
 
 
-# Load all icons at startup.
-for file in os.listdir(iconPath):
-  if fnmatch.fnmatch(file, '*.png'):
-    icons.append(Icon(file.split('.')[0]))
-
-# Assign Icons to Buttons, now that they're loaded
-for s in buttons:        # For each screenful of buttons...
-  for b in s:            #  For each button on screen...
-    for i in icons:      #   For each icon...
-      if b.bg == i.name: #    Compare names; match?
-        b.iconBg = i     #     Assign Icon to Button
-        b.bg     = None  #     Name no longer used; allow garbage collection
-      if b.fg == i.name:
-        b.iconFg = i
-        b.fg     = None
+# Icons are loaded with the layout, from the preconverted cache where
+# possible.
+iconCache = iconcache.IconCache(os.path.normpath(iconPath) + '.iconcache', display.depth)
+iconPack  = iconcache.IconCache(os.path.normpath(iconPath) + '.iconpack', display.depth)
+icons     = IconRegistry(load_icon)
+if iconPack.index and display.depth not in set(k[2] for k in iconPack.index):
+  print('Icon pack %s has no %d-bit bitmaps, so isn\'t used; rebuild it '
+        'with iconpack.py -d %d' % (iconPack.path, display.depth, display.depth))
 
+# Build Buttons from the layout file, loading the Icons it uses, and
+# prerender the keyboard layers
+load_layout(layoutPath)
+build_background()
+if formatAudit: atexit.register(format_report)
 
 # Main loop ----------------------------------------------------------------
 framecount = 0
-# Desired framerate in frames per second. Try out other values.              
-FPS = 60
+# Framerate is picked per frame from frameRates, backing off if frames
+# take too long to draw (see governor.py)
+pacer = governor.Governor(clock, frameRates)
 # How many seconds the "game" is played.
 playtime = 0.0
-while(True):
-  # Do not go faster than this framerate.
-  milliseconds = clock.tick(FPS) 
+fullRedraw = True # Repaint whole screen on next frame (e.g. first frame)
+tintStep   = None # Step of the color cycle the screen is tinted for
+nextLayoutCheck = 0
+
+# Act on one input event, which happened at time 'when' (ms)
+def handle_event(event, when):
+  global shift, fullRedraw, screen, screenPrescaled, windoww, windowh
+  if event.type is KEYDOWN:
+    if event.key == pygame.K_ESCAPE:
+      pygame.quit()
+      sys.exit()
+    if event.key == pygame.K_LSHIFT:
+      shift = True
+    press_key(event.key, when)
+  elif event.type is KEYUP:
+    if event.key == pygame.K_LSHIFT:
+      shift = False
+    release_key(event.key, when)
+  elif event.type is MOUSEBUTTONDOWN and event.button == 1:
+    touch_down('mouse', event.pos, when)
+  elif event.type is MOUSEBUTTONUP and event.button == 1:
+    touch_up('mouse', when)
+  elif event.type == FINGERDOWN:
+    # Finger positions are 0-1 across the window
+    touch_down(event.finger_id,
+      (int(event.x * windoww), int(event.y * windowh)), when)
+  elif event.type == FINGERUP:
+    touch_up(event.finger_id, when)
+  elif event.type is VIDEOEXPOSE:
+    fullRedraw = True
+  elif event.type is VIDEORESIZE:
+    if not renderThread: # Else the input thread has done this
+      pygame.display.set_mode(event.size, screen.get_flags(), 16)
+    screen = pygame.display.get_surface()
+    screenPrescaled = screen
+    format = (display.depth, display.masks)
+    display.set(screen)
+    if (display.depth, display.masks) != format: reformat_surfaces()
+    windoww, windowh = event.size
+    compute_layout()
+    fullRedraw = True
+
+# Draw one frame, once the governor says it's time, taking input from
+# get_events(), which returns a list of (time, event).
+def run_frame(get_events):
+  global playtime, nextLayoutCheck, framecount, fullRedraw, screenModePrior
+  global tintStep
+  milliseconds = pacer.tick()
   playtime += milliseconds / 1000.0 
-  keys = None
+
+  # Swap in Icons as the background loader delivers them
+  deliver_icons()
+
+  # Pick up edits to the layout file without restarting
+  if pygame.time.get_ticks() >= nextLayoutCheck:
+    nextLayoutCheck = pygame.time.get_ticks() + layoutCheck
+    check_layout()
 
   framecount = framecount + 1
 
-  for event in pygame.event.get():
-    if event.type is KEYDOWN:
-      keys = pygame.key.get_pressed()
-      if keys[pygame.K_ESCAPE]:
-        pygame.quit()
-        sys.exit()
-      if keys[pygame.K_LSHIFT]:
-        shift = True
-    elif event.type is KEYUP:
-      keys = pygame.key.get_pressed()
-      if not keys[pygame.K_LSHIFT]:
-        shift = False
-  
-  keys = pygame.key.get_pressed()
-  # Overlay buttons on display and update
-  screenPrescaled.fill(0)
+  for when, event in get_events():
+    handle_event(event, when)
   
-  lft = 0
-  top = 0
-  leftpadding = 0
-  spacinghor = 20 
-  spacingver = 30 
-  normalheight = 60
-  normalwidth = 60 
-  topheight = 60
-  topwidth = 60
-  row2key0w = 60
-  row2key13spacing = 60
-  row2key13w = 100
-  row3key0w = 90
-  row3key13w = 130 
-  row4key0w = 110 
-  row4key13spacing = 40
-  row4key13w = 90
-  row5key0w = 70 
-  row6key0w = 110 
-  row6key3w = 403 
   millis = ((round(time.time() * 1000)) % 1000)
-  reverseanimation = (millis > 500)
   millis = millis / 1000
 
+  # The tint moves on in steps, and each step repaints the whole screen,
+  # so damage-tracked frames in between tint with the color already on
+  # the rest of it.  Unless idleTint, it holds still on idle frames.
+  step = int(millis * tintSteps)
+  if step != tintStep and (idleTint or pacer.state != 'idle' or
+                           tintStep is None):
+    tintStep   = step
+    fullRedraw = True
+  millis = tintStep / float(tintSteps)
   
-  # Row 1
-  for i,b in enumerate(buttons[0]):
-    w = topwidth
-    h = topheight
-    lft = leftpadding + (i * (spacinghor + topwidth))
-    b.rect = ( lft, top, 0, 0)
-    apply_animation(b,keys,w,h, reverseanimation)
-    
-  # Row 2
-  top = top + topheight + spacingver
-
-  for i,b in enumerate(buttons[1]):
-    w = normalwidth
-    h = normalheight
-    if i == 0:
-      lft = 0
-      w = row2key0w
-    elif i == 13:
-      w = row2key13w
-      lft = ((i - 1) * (spacinghor + normalwidth)) + row2key0w + spacinghor + row2key13spacing  
-    else:
-      lft = ((i - 1) * (spacinghor + normalwidth)) + row2key0w + spacinghor
-      
-    b.rect = ( lft, top, 0, 0)
-    apply_animation(b,keys,w,h, reverseanimation)
-
-  # Row 3
-  top = top + normalheight + spacingver
-
-  for i,b in enumerate(buttons[2]):
-    w = normalwidth
-    h = normalheight
-    if i == 0:
-      lft = 0
-      w = row3key0w
-    elif i == 13:
-      w = row3key13w
-      lft = ((i - 1) * (spacinghor + normalwidth)) + row3key0w + spacinghor   
-    else:
-      lft = ((i - 1) * (spacinghor + normalwidth)) + row3key0w + spacinghor
-      
-    b.rect = ( lft, top, 0, 0)
-    apply_animation(b,keys,w,h, reverseanimation)
-
-  # Row 4
-  top = top + normalheight + spacingver
-
-  for i,b in enumerate(buttons[3]):
-    w = normalwidth
-    h = normalheight
-    if i == 0:
-      lft = 0
-      w = row4key0w	
-    elif i == 13:
-      w = row4key13w
-      lft = ((i - 1) * (spacinghor + normalwidth)) + row4key13w + spacinghor + row4key13spacing
-    else:
-      lft = ((i - 1) * (spacinghor + normalwidth)) + row4key0w + spacinghor
-      
-    b.rect = ( lft, top, 0, 0)
-    apply_animation(b,keys,w,h, reverseanimation)
- 
-  # Row 5
-  top = top + normalheight + spacingver
-
-  for i,b in enumerate(buttons[4]):
-    w = normalwidth
-    h = normalheight
-    if i == 0:
-      lft = 0
-      w = row5key0w
-    else:
-      lft = ((i - 1) * (spacinghor + normalwidth)) + row5key0w + spacinghor
-      
-    b.rect = ( lft, top, 0, 0)
-    apply_animation(b,keys,w,h, reverseanimation) 
-
-  # Row 6
-  top = top + normalheight + spacingver
-
-  for i,b in enumerate(buttons[5]):
-    w = normalwidth
-    h = normalheight
-    if i == 0:
-      lft = 0
-      w = row6key0w
-    elif i == 3:
-      w = row6key3w
-      lft = ((i - 1) * (spacinghor + normalwidth)) + row6key0w + spacinghor
-    elif i > 3:
-      lft = ((i - 2) * (spacinghor + normalwidth)) + row6key0w + spacinghor + row6key3w + spacinghor
-    else:
-      lft = ((i - 1) * (spacinghor + normalwidth)) + row6key0w + spacinghor
-      
-    b.rect = ( lft, top, 0, 0)
-    apply_animation(b,keys,w,h, reverseanimation) 
-
-  for i,b in enumerate(reversed(buttons[5])):
-    b.draw(screenPrescaled)
-  for i,b in enumerate(reversed(buttons[4])):
-    b.draw(screenPrescaled)
-  for i,b in enumerate(reversed(buttons[3])):
-    b.draw(screenPrescaled)
-  for i,b in enumerate(reversed(buttons[2])):
-    b.draw(screenPrescaled)
-  for i,b in enumerate(reversed(buttons[1])):
-    b.draw(screenPrescaled)
-  for i,b in enumerate(reversed(buttons[0])):
-    b.draw(screenPrescaled)
-
-  draw_text(screenPrescaled, font, "FPS: {:6.3}{}TIME: {:6.3} SECONDS".format(
-                           clock.get_fps(), " "*5, playtime), windoww, windowh)
-
-  #pygame.transform.scale(screenPrescaled, (windoww, windowh), screen)
-  
-  
-  overlay.fill((int(pytweening.linear(millis ) * 100),int(pytweening.linear(1.0 - millis ) * 100),int(pytweening.linear(1.0 - millis ) * 50),0))
-  screen.blit(overlay, (0,0), None, BLEND_MIN)
-  
-  pygame.display.update()
+  # Geometry comes from the precomputed layout table; only the animated
+  # size is worked out per frame, for the keys animating.
+  apply_animation()
+
+  overlayColor = (int(overlayCurve(millis ) * 100),int(overlayCurve(1.0 - millis ) * 100),int(overlayCurve(1.0 - millis ) * 50),0)
+  textDamage = statusLine.set(["{:6.1f}".format(clock.get_fps()),
+                               "{:8.0f}".format(playtime)])
+
+  if keyboardBgKey != (iconPath, layoutSerial):
+    build_background()
+    fullRedraw = True
+
+  if damageTracking and not fullRedraw:
+    # Repaint only what changed: the old and new extent of each Button
+    # whose size/image differs from last frame, plus any FPS line fields
+    # that changed, each restored from the cached background with
+    # animating Buttons and the FPS line on top.
+    # The color-cycle tint is refreshed inside these areas by filling
+    # them with the tint color using BLEND_MIN, rather than blitting a
+    # tint-filled overlay Surface; it's the current step's color, as
+    # tinted over the rest of the screen.
+    dirty = textDamage
+    for b in drawOrder:
+      dirty.extend(b.damage())
+    dirty = merge_rects(dirty)
+    for r in dirty:
+      screenPrescaled.set_clip(r)
+      draw_keys(screenPrescaled, r)
+      statusLine.draw(screenPrescaled, r)
+    screenPrescaled.set_clip(None)
+    for r in dirty:
+      screen.fill(overlayColor, r, BLEND_MIN)
+    pygame.display.update(dirty)
+  else:
+    # Overlay buttons on display and update
+    draw_keys(screenPrescaled, screenPrescaled.get_rect())
+    for b in drawOrder:
+      b.damage() # Record what was drawn
+    statusLine.draw(screenPrescaled)
+
+    #pygame.transform.scale(screenPrescaled, (windoww, windowh), screen)
+
+    screen.fill(overlayColor, None, BLEND_MIN)
+
+    pygame.display.update()
+    fullRedraw = False
  
 
 
   screenModePrior = screenMode
+  pacer.set_state(frame_state())
+
+# Input thread, with renderThread set: the main thread has to be the one
+# to take events from SDL, so it just timestamps each as it arrives and
+# queues it for the render thread, which draws frames (run_frame()) in
+# the meantime.  A long frame then delays when a key press is drawn, not
+# when it's taken, and its animation still starts from the press.
+def input_loop():
+  global running
+  running = True
+  thread  = threading.Thread(target=render_loop)
+  thread.daemon = True
+  thread.start()
+  while True:
+    event = pygame.event.wait()
+    if event.type is QUIT or (event.type is KEYDOWN and
+                              event.key == pygame.K_ESCAPE):
+      break
+    if event.type is VIDEORESIZE:
+      with frameLock:
+        pygame.display.set_mode(event.size, screen.get_flags(), 16)
+    inputQueue.append((pygame.time.get_ticks(), event))
+    inputReady.set()
+  running = False
+  inputReady.set() # Wake it if idle
+  thread.join()
+  pygame.quit()
+  sys.exit()
+
+# Render thread: each frame takes whatever input has been queued since the
+# last (deque appends and pops need no lock).  When idle, it sleeps until
+# input arrives (or idle_timeout(), as idle_wait() does) rather than
+# waiting on SDL's event queue itself.
+def render_loop():
+  def drain():
+    events = []
+    while inputQueue:
+      events.append(inputQueue.popleft())
+    return events
+  try:
+    while running:
+      if pacer.state == 'idle':
+        inputReady.wait(idle_timeout() / 1000.0)
+      inputReady.clear()
+      with frameLock:
+        run_frame(drain)
+  finally:
+    pygame.event.post(pygame.event.Event(QUIT)) # Stop input thread too
+
+if renderThread:
+  input_loop()
+while(True):
+  # With nothing to animate, block until there's an event to act on;
+  # otherwise don't go faster than the governor's framerate.  Only the
+  # event ending an idle wait is stamped as it arrives; SDL 1.2 events
+  # carry no time, so the rest are stamped when the frame takes them,
+  # up to a frame late (renderThread stamps every event on arrival).
+  events = idle_wait() if pacer.state == 'idle' else []
+  run_frame(lambda: events + [(pygame.time.get_ticks(), e)
+                              for e in pygame.event.get()])
@@ -0,0 +1,129 @@
+# Key table: the per-key size and animation state of keyb.py's Buttons,
+# held in arrays indexed by key number instead of attributes on each
+# Button.  Buttons read their animated size back from the table (see
+# Button.w etc.), and one update() per frame works out every key.
+#
+# By default the running animations are stepped one by one with
+# animation.Timelines.  A table made with arrays=True (and NumPy
+# installed) does that update as a handful of whole-array operations
+# instead, whose cost hardly grows with the number of keys animating but
+# which cost more than a few Timelines do; it only pays off with many keys
+# animating at once.  Either way a table with nothing animating does no
+# work per frame.
+#
+# Keys pulse while pressed (growing by up to pulseSize and back every
+# pulseTime ms) and, once released, ease back to rest over releaseTime.
+# Curves are easing tables (see easing.py), so NumPy can look up all keys'
+# positions on them at once.
+
+import animation
+import easing
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+REST, PULSE, RELEASE = 0, 1, 2 # Animation mode of a key
+
+
+class KeyTable:
+
+	def __init__(self, rects, pulse, release, arrays=False):
+	  self.count  = len(rects)
+	  self.arrays = arrays and numpy is not None # Update with NumPy
+	  self.pulseTime, self.pulseSize, self.pulseCurve = pulse
+	  self.releaseTime, self.releaseCurve = release
+	  self.active  = 0  # Keys not at rest
+	  self.w       = [] # Size at rest, per key
+	  self.h       = []
+	  self.cw      = [] # Current (animated) size, per key
+	  self.ch      = []
+	  self.moving  = [False] * self.count # Per key, True if animating
+	  self.pressed = [False] * self.count
+	  self.resize(rects)
+	  if not self.arrays:
+	    self.animator = animation.Animator() # Key number -> Timeline
+	    return
+	  n            = self.count
+	  self.mode    = numpy.zeros(n, numpy.int8)
+	  self.start   = numpy.zeros(n, numpy.float64) # Time (ms) mode began
+	  self.frm     = numpy.zeros(n, numpy.float64) # Growth when it began
+	  self.grow    = numpy.zeros(n, numpy.int32)   # Current growth
+	  self.pulseValues   = numpy.array(easing.table(self.pulseCurve).values)
+	  self.releaseValues = numpy.array(easing.table(self.releaseCurve).values)
+
+	# Take new rest sizes (e.g. after a window resize), one Rect per key
+	def resize(self, rects):
+	  grow    = [c - w for c, w in zip(self.cw, self.w)] or [0] * self.count
+	  self.w  = [r.w for r in rects]
+	  self.h  = [r.h for r in rects]
+	  self.cw = [w + g for w, g in zip(self.w, grow)]
+	  self.ch = [h + g for h, g in zip(self.h, grow)]
+	  if self.arrays:
+	    self.restW = numpy.array(self.w, numpy.int32)
+	    self.restH = numpy.array(self.h, numpy.int32)
+
+	def animating(self):
+	  return self.active > 0
+
+	def press(self, i, now):
+	  self.pressed[i] = True
+	  if not self.arrays:
+	    self.animator.start(i, animation.Timeline(now, self.pulseTime,
+	      self.pulseCurve, 0, self.pulseSize, pulse=True))
+	  else:
+	    self.set_mode(i, PULSE, now, 0)
+	  self.moving[i] = True
+	  self.active    = self.moving.count(True)
+
+	# Ease back from the growth the key had reached on the last update()
+	def release(self, i, now):
+	  self.pressed[i] = False
+	  if not self.moving[i]: return
+	  grow = self.cw[i] - self.w[i]
+	  if not self.arrays:
+	    self.animator.start(i, animation.Timeline(now, self.releaseTime,
+	      self.releaseCurve, grow, 0))
+	  else:
+	    self.set_mode(i, RELEASE, now, grow)
+
+	def set_mode(self, i, mode, now, grow):
+	  self.mode[i]  = mode
+	  self.start[i] = now
+	  self.frm[i]   = grow
+
+	# Work out every key's size at time now (ms)
+	def update(self, now):
+	  if not self.active: return
+	  if not self.arrays:
+	    for i, grow in self.animator.step(now):
+	      self.set_size(i, int(grow), i in self.animator)
+	  else:
+	    self.update_arrays(now)
+	  self.active = self.moving.count(True)
+
+	def set_size(self, i, grow, moving):
+	  self.cw[i]     = self.w[i] + grow
+	  self.ch[i]     = self.h[i] + grow
+	  self.moving[i] = moving
+
+	def update_arrays(self, now):
+	  mode    = self.mode
+	  pulse   = mode == PULSE
+	  release = mode == RELEASE
+	  t       = (now - self.start) / numpy.where(pulse, self.pulseTime,
+	              self.releaseTime).clip(1, None)
+	  # Pulses go 0 -> 1 -> 0 each period; releases 0 -> 1 once
+	  phase   = numpy.where(pulse, 1.0 - abs(2.0 * (t % 1.0) - 1.0), t.clip(0, 1))
+	  last    = len(self.pulseValues) - 1
+	  pi      = (phase * last + 0.5).astype(numpy.intp).clip(0, last)
+	  last    = len(self.releaseValues) - 1
+	  ri      = (phase * last + 0.5).astype(numpy.intp).clip(0, last)
+	  grow    = numpy.where(pulse, self.pulseSize * self.pulseValues[pi],
+	              self.frm * (1.0 - self.releaseValues[ri]))
+	  self.grow[:] = numpy.where(mode == REST, 0, grow)
+	  mode[release & (t >= 1.0)] = REST # Finished; at rest from now on
+	  self.cw     = (self.restW + self.grow).tolist()
+	  self.ch     = (self.restH + self.grow).tolist()
+	  self.moving = (mode != REST).tolist()
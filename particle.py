@@ -1,8 +1,9 @@
 import pygame, sys, random
+import governor
 from math import cos
 from pygame.locals import *
 
-FPS = 30
+FPS = 30 # Target rate; lowered if frames take too long (see governor.py)
 WINDOWWIDTH = 640
 WINDOWHEIGHT = 480
 FIRE = pygame.image.load('fire.png')
@@ -13,6 +14,8 @@ def main():
 	global FPSCLOCK, DISPLAYSURF
 	pygame.init()
 	FPSCLOCK = pygame.time.Clock()
+	pacer = governor.Governor(FPSCLOCK, {'particles': FPS})
+	pacer.set_state('particles')
 	DISPLAYSURF = pygame.display.set_mode((WINDOWWIDTH, WINDOWHEIGHT))
 	pygame.mouse.set_visible(0)
 	
@@ -110,7 +113,7 @@ def main():
 					break
 					
 		pygame.display.update()
-		FPSCLOCK.tick(FPS)
+		pacer.tick()
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,64 @@
+# Display pixel format manager.  Blitting a Surface whose pixel format
+# differs from the display's makes SDL convert every pixel on every blit,
+# which never shows up as such in a profile.  PixelFormat notes the
+# display Surface's actual format once (whatever depth was asked for,
+# the framebuffer may give another), converts Surfaces to exactly that
+# format, and can report any cached Surfaces that still don't match:
+#
+#   display = pixelformat.PixelFormat(screen)
+#   img     = display.convert(img)     # No-op if already in format
+#   for line in display.audit([('key q', img), ...]): print(line)
+#
+# Surfaces with per-pixel alpha (e.g. antialiased text) are blended pixel
+# by pixel anyway; they're expected to be in the display's alpha format,
+# as Surface.convert_alpha() gives.
+
+import pygame
+
+
+class PixelFormat:
+
+	def __init__(self, surface):
+	  self.set(surface)
+
+	# (Re)read the format of display Surface surface, e.g. after set_mode().
+	# The format convert_alpha() gives is found now, while the display is
+	# up, so audit() still works after pygame.quit() (e.g. at exit).
+	def set(self, surface):
+	  self.surface = surface
+	  self.depth   = surface.get_bitsize()
+	  self.masks   = surface.get_masks()
+	  s            = pygame.Surface((1, 1), pygame.SRCALPHA, 32).convert_alpha(surface)
+	  self.alpha   = (s.get_bitsize(), s.get_masks())
+
+	def matches(self, surf):
+	  return (surf.get_bitsize() == self.depth and
+	          surf.get_masks() == self.masks and
+	          not surf.get_flags() & pygame.SRCALPHA)
+
+	def matches_alpha(self, surf):
+	  return (surf.get_flags() & pygame.SRCALPHA and
+	          (surf.get_bitsize(), surf.get_masks()) == self.alpha)
+
+	# surf in display format: surf itself if it already is, else a copy
+	def convert(self, surf):
+	  return surf if self.matches(surf) else surf.convert(self.surface)
+
+	def convert_alpha(self, surf):
+	  return surf if self.matches_alpha(surf) else surf.convert_alpha(self.surface)
+
+	# Lines describing each of the (name, Surface) pairs that isn't in the
+	# display's format (or its alpha format, for Surfaces with per-pixel
+	# alpha), i.e. that will be converted pixel by pixel when blitted.
+	def audit(self, surfaces):
+	  lines = []
+	  for name, surf in surfaces:
+	    if surf is None: continue
+	    if surf.get_flags() & pygame.SRCALPHA:
+	      if self.matches_alpha(surf): continue
+	    elif self.matches(surf):
+	      continue
+	    lines.append('%s: %d-bit %s, display %d-bit %s' % (name,
+	      surf.get_bitsize(), '%x/%x/%x/%x' % surf.get_masks(),
+	      self.depth, '%x/%x/%x/%x' % self.masks))
+	  return lines